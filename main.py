@@ -1,12 +1,27 @@
-from fastapi import FastAPI, UploadFile, File # type: ignore
+from fastapi import FastAPI, UploadFile, File, HTTPException, Header # type: ignore
 from fastapi.middleware.cors import CORSMiddleware # type: ignore
-from fastapi.responses import StreamingResponse, JSONResponse # type: ignore
+from fastapi.responses import StreamingResponse, JSONResponse, Response # type: ignore
 from pydantic import BaseModel # type: ignore
-from openai import OpenAI # type: ignore
+from openai import OpenAI, APITimeoutError, APIConnectionError, RateLimitError, InternalServerError # type: ignore
 import pdfplumber # type: ignore
+from pdfplumber.utils.exceptions import PdfminerException # type: ignore
 import os
 import random
 import logging
+import json
+import sqlite3
+import threading
+import time
+import uuid
+import asyncio
+import contextlib
+import contextvars
+import hmac
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, OrderedDict
+from typing import Optional
 logging.basicConfig(level=logging.INFO)
 
 # --- Initialize OpenAI ---
@@ -100,10 +115,256 @@ PRESETS = {
     ]
 }
 
+# --- Rapid-Fire Extracurricular Follow-Ups ---
+# Asked in order for each activity; the checks in next_question detect which
+# ones have already been asked from their wording.
+EXTRACURRICULAR_FOLLOW_UPS = [
+    "Could you tell me more about {activity} and how long you’ve done it? What’s your role in it? What do you bring to it personally?",
+    "What do you enjoy about {activity}? What’s been most rewarding?",
+    "What have you found challenging about this work in {activity}?",
+    "What have you learned about yourself or others from your involvement in {activity}?",
+    "Do you see yourself continuing {activity}? If you’ve stopped or had to cut back (or will do in the future), how do you feel?",
+    "Do you have any anecdotes, moments or take-aways that stand out from {activity}?",
+    "Is there anything more you want to add regarding {activity}? If not, let’s move on.",
+]
+
+# --- Prompt Templates ---
+# Every prompt is laid out as: the call site's static system prompt, then the
+# student's CV, then the static instructions and finally the per-turn data.
+# Keeping the variable parts at the end lets upstream prompt-prefix caching
+# reuse the longest possible prefix across the turns of a session. Only the
+# sites that pick themes carry the theme list; they share THEMES_PREAMBLE
+# byte for byte.
+THEMES_PREAMBLE = (
+    "You are a warm, perceptive assistant to a college counselor. The college counselor has asked you to interview "
+    "the student, taking the preset questions as a starting point. The college counselor will use the interview "
+    "transcript to brainstorm potential college application essay topics with the student.\n\n"
+    "Each request describes one task: either asking the student the next question or identifying the essay theme "
+    "of the conversation so far. Follow the task instructions of each request.\n\n"
+    "List of preset themes:\n"
+    + "\n".join(PRESET_THEMES)
+)
+
+
+class PromptTemplate:
+    def __init__(self, system, instructions, turn="", include_cv=False):
+        self.system = system
+        self.instructions = instructions.strip()
+        self.turn = turn.strip()
+        self.include_cv = include_cv
+
+    def messages(self, cv_text="", **turn_data):
+        messages = [{"role": "system", "content": self.system}]
+        if self.include_cv:
+            messages.append({"role": "user", "content": f"Student's CV:\n{cv_text}"})
+        content = self.instructions
+        if self.turn:
+            content += "\n\n" + self.turn.format(**turn_data)
+        messages.append({"role": "user", "content": content})
+        return messages
+
+
+PROMPTS = {
+    "extract_fav_subjects": PromptTemplate(
+        system="You extract structured academic subject names from student replies.",
+        instructions="""
+The student was asked to list three or four of their favourite academic subjects.
+
+Return a Python list of 3–4 academic subject names only. If none are identifiable, return an empty list.
+""",
+        turn="""
+Here is their answer:
+"{last_answer}"
+""",
+    ),
+    "ask_fav_subjects": PromptTemplate(
+        system="You are a warm, perceptive assistant.",
+        include_cv=True,
+        instructions="""
+The student has not yet listed their favorite academic subjects.
+
+If the CV is provided ask: "Looks like [3–4 most relevant subjects from the CV] are your favorite subjects. Regardless, could you tell me about three or four of your favourite subjects?"
+If the CV is not provided ask: "Could you tell me about three or four of your favourite subjects?"
+""",
+    ),
+    "extract_courses": PromptTemplate(
+        system="You are an assistant extracting structured academic data from resumes.",
+        include_cv=True,
+        instructions="""
+From the student's CV, extract up to 3 specific courses or classes related to the subject below.
+If there are none, respond with "None".
+""",
+        turn="""
+Subject: "{field}"
+""",
+    ),
+    "extract_experiences": PromptTemplate(
+        system="You are an assistant extracting structured academic data from resumes.",
+        include_cv=True,
+        instructions="""
+From the student's CV, extract up to 3 specific research projects, internships, or extracurricular experiences related to the subject below.
+If there are none, respond with "None".
+""",
+        turn="""
+Subject: "{field}"
+""",
+    ),
+    "extract_top_activities": PromptTemplate(
+        system="You extract top-tier extracurricular activities for college admissions.",
+        include_cv=True,
+        instructions="""
+From the student's CV, extract the 5 **most impressive and diverse** extracurricular activities that would stand out to a college admissions officer. Avoid overlapping roles (e.g., two similar research projects).
+
+Return them as a Python list of short activity names only.
+""",
+    ),
+    "extract_activity_list": PromptTemplate(
+        system="You extract structured extracurricular activity names from student replies.",
+        instructions="""
+The student was asked to list the 5 extracurricular activities they want to talk about today.
+
+Return a Python list of exactly 5 activity names only.
+""",
+        turn="""
+Here is their answer:
+"{last_answer}"
+""",
+    ),
+    "family_background": PromptTemplate(
+        system="You are a friendly college counselor helping a student reflect on their background.",
+        instructions="""
+Your goal is to ask the preset questions **one by one in the given order** from the “Family & Background” list. Do not invent new questions or reorder them. Add a short, friendly sentence that naturally reacts to the student’s **last answer**, and then ask the **next** question.
+
+Begin with a natural transition or reflection, and then ask the question in a conversational tone.
+""",
+        turn="""
+Here is the student's previous answer:
+"{last_answer}"
+
+The next question to ask is:
+"{next_question}"
+""",
+    ),
+    "academic_interests": PromptTemplate(
+        system="You are a friendly college counselor helping a student reflect on their academic life.",
+        instructions="""
+Your goal is to ask the preset questions **one by one in the given order** from the “Academic Interests” list. Do not invent new questions or reorder them. Add a short, friendly sentence that naturally reacts to the student’s **last answer**, and then ask the **next** question.
+
+Begin with a natural transition or reflection, and then ask the question in a conversational tone.
+""",
+        turn="""
+Here is the student's previous answer:
+"{last_answer}"
+
+The next question to ask is:
+"{next_question}"
+""",
+    ),
+    "default_question": PromptTemplate(
+        system=THEMES_PREAMBLE,
+        include_cv=True,
+        instructions="""
+Your task is to:
+a. Gather as much detail as possible about the student’s academic interests or extracurricular involvement or personal background (depending on the choosen track). These details are necessary for the counselor.
+b. Build on these details with further questions about the student’s motivation and character as it relates to the subject being discussed.
+
+If the student has not provided a CV pay more attention to conversation history and preset questions.
+
+If the academic track is choosen ask at least once about challanges and obstacles in the academic life of the student.
+
+Pick the most relevant preset question from the list according to the conversation history and the CV.
+
+Pick a relevant theme from the list of preset themes. This should help you give direction to the question.
+
+Instructions:
+- Check the conversation history and theme counts to see what themes have been discussed.
+- Ask at most TWO questions per theme. After two, switch to a new theme. To understand how many times the theme has been discussed check the theme counts and conversation history.
+- Prioritize themes that have NOT yet been discussed.
+- If this is not the first question, before generating a question check the conversation history to give 1-2 lines of reflection (something like that sounds interesting) to the students response and then ask the question.
+- NEVER repeat a topic already deeply discussed.
+- Build naturally based on student's previous answers.
+- Stay strictly related to the selected track unless a powerful personal connection emerges.
+- Phrase your questions conversationally, like a real human counselor talking warmly to a student.
+- Prefer open-ended questions that encourage reflection and storytelling.
+- Only output ONE question, no lists or options.
+- Do not begin with "Q:".
+
+Reminder:
+- Stay human, curious, and perceptive.
+- Adapt wording naturally using clues from the CV and past conversation.
+""",
+        turn="""
+Interview Track: {track}
+
+Preset question to base your next move on:
+"{track_questions}"
+
+Conversation so far:
+{conversation_history}
+
+Themes discussed and their counts:
+{theme_counts}
+""",
+    ),
+    "classify_theme": PromptTemplate(
+        system=THEMES_PREAMBLE,
+        instructions="""
+You are a classifier that identifies essay themes from conversation.
+
+Pick one most relevant theme from the list of preset themes for the conversation below.
+""",
+        turn="""
+Given this conversation:
+{conversation_history}
+""",
+    ),
+}
+
 # --- Configuration ---
 MAX_CHAR_HISTORY = 4000
 MAX_TURNS = 8
 
+# --- Background Jobs ---
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "jobs.db")
+JOB_FILES_DIR = os.getenv("JOB_FILES_DIR", "job_files")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_BACKOFF_SECONDS = float(os.getenv("JOB_BACKOFF_SECONDS", "2"))
+JOB_POLL_SECONDS = 1.0
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_EVENTS_MAX_SECONDS = float(os.getenv("JOB_EVENTS_MAX_SECONDS", "300"))
+
+# --- Deadlines ---
+# Time budget for all upstream calls made while answering one /next-question
+# request. Clients can shorten it per request with the X-Deadline-Ms header.
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "6"))
+# Transient upstream errors are retried while the deadline allows it
+UPSTREAM_MAX_RETRIES = 2
+UPSTREAM_RETRY_BACKOFF_SECONDS = 0.5
+
+# --- Profiling ---
+# Requests are profiled when they carry "X-Profile: 1" or are picked by the
+# sampling rate. Profiles are kept in memory and served from /debug/profiles,
+# which is only enabled when DEBUG_TOKEN is set.
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_MAX_STORED = int(os.getenv("PROFILE_MAX_STORED", "200"))
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "")
+
+# --- Prefetch ---
+# Opt-in mode: after answering a turn the server speculatively prepares work for
+# the next one (TTS audio, CV extraction) and keeps it in a short-lived
+# per-session cache.
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "0") == "1"
+PREFETCH_TTL_SECONDS = float(os.getenv("PREFETCH_TTL_SECONDS", "300"))
+PREFETCH_MAX_ENTRIES = int(os.getenv("PREFETCH_MAX_ENTRIES", "1000"))
+PREFETCH_DEADLINE_SECONDS = float(os.getenv("PREFETCH_DEADLINE_SECONDS", "30"))
+# Prefetch runs on its own small pool so it never queues ahead of interactive calls
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "2"))
+# How long an interactive request waits for a prefetch that is still running
+# before doing the work itself
+PREFETCH_WAIT_SECONDS = float(os.getenv("PREFETCH_WAIT_SECONDS", "0.2"))
+PREFETCH_TTS_TIMEOUT_SECONDS = float(os.getenv("PREFETCH_TTS_TIMEOUT_SECONDS", "20"))
+
 # --- Data Schema ---
 class QuestionRequest(BaseModel):
     track: str
@@ -116,6 +377,7 @@ class QuestionRequest(BaseModel):
     extracurricular_fields: list = []  # For top 5 activities
     background_index: int = 0
     academic_index: int = 0
+    session_id: str = ""  # Scopes the prefetch cache; no prefetch without one
 
 # --- Utility: History Trimming ---
 def smart_conversation_history(history):
@@ -129,20 +391,684 @@ def smart_conversation_history(history):
     return f"{all_questions}\n{last_q_and_a}".strip()
 
 
+# --- Utility: Question Tagging ---
+def question_tag(question):
+    if "three or four of your favourite subjects" in question.lower():
+        return "ask_fav_subjects"
+    elif "most important 5 activities" in question.lower():
+        return "ask_top_activities"
+    return ""
+
+
+# --- Utility: Fallback Question ---
+DEFAULT_FALLBACK_QUESTION = "Is there anything else about yourself that you would like to share and that we haven’t talked about yet?"
+
+
+def fallback_preset(track_questions, history):
+    """A preset from the track that has not been asked yet, chosen at random."""
+    asked = [turn.get("question", "").lower() for turn in history]
+    unasked = [q for q in track_questions if not any(q.lower() in a for a in asked)]
+    return random.choice(unasked) if unasked else DEFAULT_FALLBACK_QUESTION
+
+
+# --- Metrics ---
+# How often each call site gave up on the LLM (missed deadline or persistent
+# upstream errors) and served a deterministic fallback
+FALLBACK_COUNTS = Counter()
+# Prompt and upstream-cached prompt tokens reported for each call site
+PROMPT_TOKENS = Counter()
+CACHED_PROMPT_TOKENS = Counter()
+COMPLETION_CALLS = Counter()
+
+
+def record_prompt_usage(site, response):
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", 0) or 0) if details is not None else 0
+    COMPLETION_CALLS[site] += 1
+    PROMPT_TOKENS[site] += usage.prompt_tokens or 0
+    CACHED_PROMPT_TOKENS[site] += cached
+    logging.info(f"[CACHE] {site}: {cached}/{usage.prompt_tokens} prompt tokens served from cache")
+
+
+# --- Request Profiling ---
+class RequestProfile:
+    """Wall-clock and CPU time of one request, broken down by named phases.
+
+    CPU time is process-wide, so it also includes work done for concurrent
+    requests while this one was in a phase.
+    """
+
+    def __init__(self, request_id, method, path):
+        self.request_id = request_id
+        self.method = method
+        self.path = path
+        self.started_at = time.time()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        self.phases = OrderedDict()
+        self.total = None
+
+    def _record(self, name, wall, cpu):
+        entry = self.phases.setdefault(name, {"wall_ms": 0.0, "cpu_ms": 0.0, "calls": 0})
+        entry["wall_ms"] += wall * 1000
+        entry["cpu_ms"] += cpu * 1000
+        entry["calls"] += 1
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self._record(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def mark(self, name):
+        # Record the time from the start of the request up to now as a phase
+        self._record(name, time.perf_counter() - self.wall_start, time.process_time() - self.cpu_start)
+
+    def finish(self):
+        self.total = (time.perf_counter() - self.wall_start, time.process_time() - self.cpu_start)
+
+    def to_dict(self):
+        wall, cpu = self.total or (time.perf_counter() - self.wall_start, time.process_time() - self.cpu_start)
+        phases = {name: {k: round(v, 3) if isinstance(v, float) else v for k, v in entry.items()}
+                  for name, entry in self.phases.items()}
+        return {
+            "request_id": self.request_id,
+            "method": self.method,
+            "path": self.path,
+            "started_at": self.started_at,
+            "wall_ms": round(wall * 1000, 3),
+            "cpu_ms": round(cpu * 1000, 3),
+            "phases": phases,
+        }
+
+
+PROFILES = OrderedDict()
+_current_profile = contextvars.ContextVar("current_profile", default=None)
+_NO_PHASE = contextlib.nullcontext()
+
+
+def profile_phase(name):
+    profile = _current_profile.get()
+    return profile.phase(name) if profile is not None else _NO_PHASE
+
+
+def profile_mark(name):
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.mark(name)
+
+
+class ProfilingMiddleware:
+    """ASGI middleware that attaches a RequestProfile to opted-in requests."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        requested = headers.get(b"x-profile", b"").lower() in (b"1", b"true")
+        if not requested and (PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE):
+            return await self.app(scope, receive, send)
+
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1") or uuid.uuid4().hex
+        # Never overwrite an earlier profile stored under the same client ID
+        if request_id in PROFILES:
+            request_id = f"{request_id}-{uuid.uuid4().hex[:8]}"
+        profile = RequestProfile(request_id, scope["method"], scope["path"])
+        # Registered up front so concurrent requests with the same ID see it taken
+        PROFILES[request_id] = profile
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        token = _current_profile.set(profile)
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            _current_profile.reset(token)
+            profile.finish()
+            while len(PROFILES) > PROFILE_MAX_STORED:
+                PROFILES.popitem(last=False)
+            logging.info(f"[PROFILE] Stored profile {request_id} for {scope['path']}")
+
+
+app.add_middleware(ProfilingMiddleware)
+
+
+# --- Utility: Deadline-Bound Chat Completions ---
+async def chat_completion(deadline, site, executor=None, **kwargs):
+    """Run a chat completion within the request deadline.
+
+    Connection errors, rate limits and server errors are retried while budget
+    remains. Returns None when the call misses its budget or keeps failing so
+    the caller can serve a deterministic fallback instead. The blocking call
+    runs on the default executor unless another one is given.
+    """
+    for attempt in range(UPSTREAM_MAX_RETRIES + 1):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logging.warning(f"[DEADLINE] No budget left for {site}, using fallback")
+            break
+        bounded_client = client.with_options(timeout=remaining, max_retries=0)
+        try:
+            if executor is None:
+                call = asyncio.to_thread(bounded_client.chat.completions.create, **kwargs)
+            else:
+                call = asyncio.get_running_loop().run_in_executor(
+                    executor, functools.partial(bounded_client.chat.completions.create, **kwargs)
+                )
+            with profile_phase(f"upstream:{site}"):
+                response = await asyncio.wait_for(call, timeout=remaining)
+        except (asyncio.TimeoutError, APITimeoutError):
+            logging.warning(f"[DEADLINE] {site} missed its {remaining:.2f}s budget, using fallback")
+            break
+        except (APIConnectionError, RateLimitError, InternalServerError) as e:
+            delay = UPSTREAM_RETRY_BACKOFF_SECONDS * (2 ** attempt)
+            if attempt == UPSTREAM_MAX_RETRIES or deadline - time.monotonic() <= delay:
+                logging.warning(f"[UPSTREAM] {site} failed (attempt {attempt + 1}), using fallback. Error: {e}")
+                break
+            logging.warning(f"[UPSTREAM] {site} failed (attempt {attempt + 1}), retrying in {delay}s. Error: {e}")
+            await asyncio.sleep(delay)
+        else:
+            record_prompt_usage(site, response)
+            return response
+    FALLBACK_COUNTS[site] += 1
+    return None
+
+
+# --- Speculative Prefetch ---
+# Entries map (session_id, kind, *key) to an asyncio task. A request that
+# arrives while its prefetch is still running waits at most
+# PREFETCH_WAIT_SECONDS for it and otherwise does the work itself, so queued
+# background work never spends the request's deadline.
+PREFETCH_CACHE = OrderedDict()
+PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+PREFETCH_HITS = Counter()
+PREFETCH_MISSES = Counter()
+PREFETCH_SCHEDULED = Counter()
+# Lookups answered by a result an earlier request computed itself, not a prefetch
+PREFETCH_REUSED = Counter()
+
+
+def prefetch_key(session_id, kind, *parts):
+    return (session_id, kind) + parts
+
+
+def cv_digest(cv_text):
+    return hashlib.sha1(cv_text.encode("utf-8")).hexdigest()[:16]
+
+
+def _evict_prefetched():
+    now = time.monotonic()
+    while PREFETCH_CACHE:
+        key, (expires_at, _, _) = next(iter(PREFETCH_CACHE.items()))
+        if expires_at > now and len(PREFETCH_CACHE) <= PREFETCH_MAX_ENTRIES:
+            break
+        PREFETCH_CACHE.popitem(last=False)
+
+
+def _log_prefetch_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.warning(f"[PREFETCH] Prefetch failed. Error: {task.exception()}")
+
+
+def schedule_prefetch(key, make_coro):
+    # Without a session ID there is no namespace to keep results apart
+    if not PREFETCH_ENABLED or not key[0]:
+        return
+    _evict_prefetched()
+    if key in PREFETCH_CACHE:
+        return
+
+    async def run():
+        # Keep background work out of the profile of the request that scheduled it
+        _current_profile.set(None)
+        return await make_coro()
+
+    task = asyncio.create_task(run())
+    task.add_done_callback(_log_prefetch_failure)
+    PREFETCH_CACHE[key] = (time.monotonic() + PREFETCH_TTL_SECONDS, task, True)
+    PREFETCH_SCHEDULED[key[1]] += 1
+
+
+def store_prefetched(key, value):
+    if not PREFETCH_ENABLED or not key[0]:
+        return
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(value)
+    PREFETCH_CACHE[key] = (time.monotonic() + PREFETCH_TTL_SECONDS, future, False)
+    PREFETCH_CACHE.move_to_end(key)
+    _evict_prefetched()
+
+
+async def use_prefetched(key, wait=PREFETCH_WAIT_SECONDS):
+    """Return (hit, value) for a cached prefetch, waiting briefly if it is still running."""
+    if not PREFETCH_ENABLED or not key[0]:
+        return False, None
+    _evict_prefetched()
+    entry = PREFETCH_CACHE.get(key)
+    value = None
+    if entry is not None:
+        _, task, prefetched = entry
+        try:
+            if task.done():
+                value = task.result()
+            elif wait > 0:
+                # shield() keeps the prefetch running for later turns if we stop waiting
+                value = await asyncio.wait_for(asyncio.shield(task), wait)
+        except Exception:
+            value = None
+    if value is None:
+        PREFETCH_MISSES[key[1]] += 1
+        return False, None
+    if prefetched:
+        PREFETCH_HITS[key[1]] += 1
+    else:
+        PREFETCH_REUSED[key[1]] += 1
+    return True, value
+
+
+def synthesize_speech(text):
+    bounded_client = client.with_options(timeout=PREFETCH_TTS_TIMEOUT_SECONDS, max_retries=0)
+    speech = bounded_client.audio.speech.create(
+        model="tts-1",
+        input=text,
+        voice="nova",
+        response_format="mp3"
+    )
+    return speech.read()
+
+
+def prefetch_speech(session_id, text):
+    if text:
+        schedule_prefetch(
+            prefetch_key(session_id, "tts", text),
+            lambda: asyncio.get_running_loop().run_in_executor(PREFETCH_EXECUTOR, synthesize_speech, text)
+        )
+
+
+async def extract_cv_detail(site, cv_text, field, deadline, executor=None, label=None):
+    # label keeps background calls apart from interactive ones in the metrics
+    response = await chat_completion(
+        deadline, label or site,
+        executor=executor,
+        model="gpt-4",
+        messages=PROMPTS[site].messages(cv_text=cv_text, field=field)
+    )
+    return response.choices[0].message.content.strip() if response is not None else None
+
+
+async def cv_detail(req, site, field, deadline):
+    """Courses or experiences for a field, served from the prefetch cache when possible."""
+    key = prefetch_key(req.session_id, site, cv_digest(req.cv_text), field)
+    hit, detail = await use_prefetched(key, min(PREFETCH_WAIT_SECONDS, max(deadline - time.monotonic(), 0)))
+    if not hit:
+        detail = await extract_cv_detail(site, req.cv_text, field, deadline)
+        if detail is not None:
+            store_prefetched(key, detail)
+    return detail or "None"
+
+
+def prefetch_cv_details(req, field):
+    for site in ("extract_courses", "extract_experiences"):
+        key = prefetch_key(req.session_id, site, cv_digest(req.cv_text), field)
+        schedule_prefetch(
+            key,
+            lambda site=site: extract_cv_detail(
+                site, req.cv_text, field, time.monotonic() + PREFETCH_DEADLINE_SECONDS,
+                executor=PREFETCH_EXECUTOR, label=f"prefetch:{site}"
+            )
+        )
+
+
+# --- Utility: CV Parsing ---
+def extract_pdf_text(path):
+    with pdfplumber.open(path) as pdf:
+        return "\n".join([page.extract_text() for page in pdf.pages if page.extract_text()])
+
+
+# --- Background Job Queue ---
+# Jobs are persisted in SQLite so queued work survives a restart. A bounded pool
+# of worker threads claims queued jobs, runs the handler registered for the job
+# kind and stores the JSON result. Failed jobs are retried with exponential
+# backoff until JOB_MAX_ATTEMPTS is reached. A claim is a lease that the worker
+# renews while the job runs; jobs whose lease expired (their process died) are
+# claimed again, and only the current lease holder can finish a job.
+JOB_HANDLERS = {}
+JOB_CLEANUPS = {}
+
+
+class PermanentJobError(Exception):
+    """Raised by a job handler when retrying cannot help, e.g. for a corrupt input file."""
+_job_wakeup = threading.Event()
+_job_stop = threading.Event()
+_job_threads = []
+
+
+def job_handler(kind, cleanup=None):
+    # cleanup(payload) runs once the job is done or has failed for good
+    def register(fn):
+        JOB_HANDLERS[kind] = fn
+        if cleanup is not None:
+            JOB_CLEANUPS[kind] = cleanup
+        return fn
+    return register
+
+
+def _cleanup_job(kind, job_id, payload):
+    cleanup = JOB_CLEANUPS.get(kind)
+    if cleanup is None:
+        return
+    try:
+        cleanup(payload)
+    except Exception as e:
+        logging.warning(f"[JOBS] Cleanup for {kind} job {job_id} failed. Error: {e}")
+
+
+def _job_db():
+    conn = sqlite3.connect(JOB_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+def init_job_db():
+    conn = _job_db()
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                run_after REAL NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                claim_token TEXT,
+                locked_until REAL
+            )
+        """)
+        # Databases created before leases were added lack the lease columns
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for column, column_type in (("claim_token", "TEXT"), ("locked_until", "REAL")):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+        # Running rows without a lease can be reclaimed straight away
+        conn.execute("UPDATE jobs SET locked_until = 0 WHERE status = 'running' AND locked_until IS NULL")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (status, run_after)")
+    finally:
+        conn.close()
+
+
+def submit_job(kind, payload):
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    conn = _job_db()
+    try:
+        conn.execute(
+            "INSERT INTO jobs (id, kind, payload, status, attempts, run_after, created_at, updated_at) "
+            "VALUES (?, ?, ?, 'queued', 0, ?, ?, ?)",
+            (job_id, kind, json.dumps(payload), now, now, now)
+        )
+    finally:
+        conn.close()
+    logging.info(f"[JOBS] Submitted {kind} job {job_id}")
+    _job_wakeup.set()
+    return job_id
+
+
+def get_job(job_id):
+    conn = _job_db()
+    try:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    return {
+        "job_id": row["id"],
+        "kind": row["kind"],
+        "status": row["status"],
+        "attempts": row["attempts"],
+        "result": json.loads(row["result"]) if row["result"] is not None else None,
+        "error": row["error"],
+    }
+
+
+def _claim_job(conn):
+    now = time.time()
+    token = uuid.uuid4().hex
+    abandoned = []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        while True:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE (status = 'queued' AND run_after <= ?) "
+                "OR (status = 'running' AND locked_until <= ?) ORDER BY run_after LIMIT 1",
+                (now, now)
+            ).fetchone()
+            if row is None or row["status"] != "running" or row["attempts"] < JOB_MAX_ATTEMPTS:
+                break
+            # The job took its worker down on every attempt; stop re-running it
+            logging.error(f"[JOBS] {row['kind']} job {row['id']} lost its lease on all {row['attempts']} attempts, giving up")
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                (f"Lease expired on all {row['attempts']} attempts", now, row["id"])
+            )
+            abandoned.append(row)
+        if row is not None:
+            if row["status"] == "running":
+                logging.info(f"[JOBS] Reclaiming {row['kind']} job {row['id']} after its lease expired")
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, claim_token = ?, "
+                "locked_until = ?, updated_at = ? WHERE id = ?",
+                (token, now + JOB_LEASE_SECONDS, now, row["id"])
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    for failed in abandoned:
+        _cleanup_job(failed["kind"], failed["id"], json.loads(failed["payload"]))
+    return (row, token) if row is not None else (None, None)
+
+
+def _renew_lease(job_id, token, done):
+    conn = _job_db()
+    try:
+        while not done.wait(JOB_LEASE_SECONDS / 3):
+            try:
+                conn.execute(
+                    "UPDATE jobs SET locked_until = ? WHERE id = ? AND status = 'running' AND claim_token = ?",
+                    (time.time() + JOB_LEASE_SECONDS, job_id, token)
+                )
+            except sqlite3.Error as e:
+                logging.warning(f"[JOBS] Failed to renew lease for job {job_id}. Error: {e}")
+    finally:
+        conn.close()
+
+
+def _finish_job(conn, job_id, token, assignments, params):
+    # Only the current lease holder may end the job
+    updated = conn.execute(
+        f"UPDATE jobs SET {assignments}, updated_at = ? WHERE id = ? AND status = 'running' AND claim_token = ?",
+        params + (time.time(), job_id, token)
+    ).rowcount
+    if not updated:
+        logging.warning(f"[JOBS] Lost the lease on job {job_id}, discarding this attempt")
+    return bool(updated)
+
+
+def _run_job(conn, row, token):
+    job_id, kind = row["id"], row["kind"]
+    attempts = row["attempts"] + 1
+    payload = json.loads(row["payload"])
+    done = threading.Event()
+    heartbeat = threading.Thread(target=_renew_lease, args=(job_id, token, done), daemon=True)
+    heartbeat.start()
+    try:
+        # Serialising inside the try makes an unstorable result a failed attempt
+        result = json.dumps(JOB_HANDLERS[kind](payload))
+    except Exception as e:
+        if attempts < JOB_MAX_ATTEMPTS and not isinstance(e, PermanentJobError):
+            delay = JOB_BACKOFF_SECONDS * (2 ** (attempts - 1))
+            logging.warning(f"[JOBS] {kind} job {job_id} failed (attempt {attempts}), retrying in {delay}s. Error: {e}")
+            _finish_job(conn, job_id, token, "status = 'queued', error = ?, run_after = ?", (str(e), time.time() + delay))
+        else:
+            logging.error(f"[JOBS] {kind} job {job_id} failed permanently after {attempts} attempt(s). Error: {e}")
+            if _finish_job(conn, job_id, token, "status = 'failed', error = ?", (str(e),)):
+                _cleanup_job(kind, job_id, payload)
+        return
+    finally:
+        done.set()
+    if _finish_job(conn, job_id, token, "status = 'done', result = ?, error = NULL", (result,)):
+        logging.info(f"[JOBS] {kind} job {job_id} done")
+        _cleanup_job(kind, job_id, payload)
+
+
+def _job_worker():
+    conn = _job_db()
+    try:
+        while not _job_stop.is_set():
+            try:
+                row, token = _claim_job(conn)
+            except sqlite3.Error as e:
+                logging.warning(f"[JOBS] Failed to claim job. Error: {e}")
+                row = None
+            if row is None:
+                _job_wakeup.wait(JOB_POLL_SECONDS)
+                _job_wakeup.clear()
+                continue
+            try:
+                _run_job(conn, row, token)
+            except Exception as e:
+                # Never let one job take the worker thread down with it
+                logging.error(f"[JOBS] Worker failed while finishing job {row['id']}. Error: {e}")
+    finally:
+        conn.close()
+
+
+@app.on_event("startup")
+def start_job_workers():
+    os.makedirs(JOB_FILES_DIR, exist_ok=True)
+    init_job_db()
+    _job_stop.clear()
+    for i in range(JOB_WORKERS):
+        thread = threading.Thread(target=_job_worker, name=f"job-worker-{i}", daemon=True)
+        thread.start()
+        _job_threads.append(thread)
+
+
+@app.on_event("shutdown")
+def stop_job_workers():
+    _job_stop.set()
+    _job_wakeup.set()
+    for thread in _job_threads:
+        thread.join(timeout=5)
+    _job_threads.clear()
+
+
+def save_job_file(contents, suffix):
+    path = os.path.join(JOB_FILES_DIR, f"{uuid.uuid4().hex}{suffix}")
+    with open(path, "wb") as f:
+        f.write(contents)
+    return path
+
+
+def remove_job_file(payload):
+    if os.path.exists(payload["path"]):
+        os.remove(payload["path"])
+
+
+@job_handler("parse_cv", cleanup=remove_job_file)
+def parse_cv_job(payload):
+    try:
+        return {"text": extract_pdf_text(payload["path"])}
+    except PdfminerException as e:
+        raise PermanentJobError(f"Could not parse the PDF: {e}")
+
+
 # --- Endpoint: Upload CV ---
 @app.post("/upload-cv")
-async def upload_cv(file: UploadFile = File(...)):
-    contents = await file.read()
+async def upload_cv(file: UploadFile = File(...), background: bool = False):
+    with profile_phase("upload_read"):
+        contents = await file.read()
+    if background:
+        # Hand parsing off to the job queue and return the job ID right away
+        path = await asyncio.to_thread(save_job_file, contents, ".pdf")
+        job_id = await asyncio.to_thread(submit_job, "parse_cv", {"path": path})
+        return {"job_id": job_id, "status": "queued"}
     with open("temp_cv.pdf", "wb") as f:
         f.write(contents)
-    with pdfplumber.open("temp_cv.pdf") as pdf:
-        text = "\n".join([page.extract_text() for page in pdf.pages if page.extract_text()])
+    with profile_phase("pdf_extract"):
+        text = extract_pdf_text("temp_cv.pdf")
     return {"text": text}
 
+
+# --- Endpoint: Job Status ---
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = await asyncio.to_thread(get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
+
+# --- Endpoint: Job Events ---
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    job = await asyncio.to_thread(get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+
+    async def stream():
+        last_state = None
+        # Stop polling eventually even if the job never finishes
+        stop_at = time.monotonic() + JOB_EVENTS_MAX_SECONDS
+        while True:
+            current = await asyncio.to_thread(get_job, job_id)
+            state = (current["status"], current["attempts"])
+            if state != last_state:
+                yield f"data: {json.dumps(current)}\n\n"
+                last_state = state
+            if current["status"] in ("done", "failed"):
+                return
+            if time.monotonic() >= stop_at:
+                yield f"event: timeout\ndata: {json.dumps(current)}\n\n"
+                return
+            await asyncio.sleep(JOB_POLL_SECONDS)
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
 # --- Endpoint: Get Next Question ---
 @app.post("/next-question")
-async def next_question(req: QuestionRequest):
-    conversation_history = smart_conversation_history(req.history)
+async def next_question(req: QuestionRequest, x_deadline_ms: Optional[int] = Header(None)):
+    # Everything before this point: receiving the body from the network, JSON
+    # parsing and Pydantic validation
+    profile_mark("request_receive_and_validate")
+    # A client may ask for a tighter budget, never a looser or empty one
+    if x_deadline_ms and x_deadline_ms > 0:
+        budget = min(x_deadline_ms / 1000, REQUEST_DEADLINE_SECONDS)
+    else:
+        budget = REQUEST_DEADLINE_SECONDS
+    deadline = time.monotonic() + budget
+    with profile_phase("history_format"):
+        conversation_history = smart_conversation_history(req.history)
     # --- Extract structured info based on tags ---
     if req.history:
         last_tag = req.history[-1].get("tag", "")
@@ -155,9 +1081,6 @@ async def next_question(req: QuestionRequest):
 
     conversation_history = conversation_history or "This is the first question."
     track_questions = PRESETS.get(req.track, [])
-    selected_preset = random.choice(track_questions) if track_questions else ""
-    themes = PRESET_THEMES
-    tag = ""
 
     
     
@@ -182,24 +1105,17 @@ async def next_question(req: QuestionRequest):
                     ""
                 )
                 
-                extraction_prompt = f"""
-The student was asked to list three or four of their favourite academic subjects.
-
-Here is their answer:
-"{last_answer}"
-
-Return a Python list of 3–4 academic subject names only. If none are identifiable, return an empty list.
-"""
-                extraction_response = client.chat.completions.create(
+                extraction_response = await chat_completion(
+                    deadline, "extract_fav_subjects",
                     model="gpt-4",
-                    messages=[
-                        {"role": "system", "content": "You extract structured academic subject names from student replies."},
-                        {"role": "user", "content": extraction_prompt}
-                    ]
+                    messages=PROMPTS["extract_fav_subjects"].messages(last_answer=last_answer)
                 )
-                extracted = extraction_response.choices[0].message.content.strip()
-                logging.info(f"[INFO] Extracted raw subject list string: {extracted}")
-                req.academic_fields = eval(extracted) if extracted.startswith("[") else []     
+                if extraction_response is None:
+                    req.academic_fields = [s.strip() for s in last_answer.split(",") if s.strip()]
+                else:
+                    extracted = extraction_response.choices[0].message.content.strip()
+                    logging.info(f"[INFO] Extracted raw subject list string: {extracted}")
+                    req.academic_fields = eval(extracted) if extracted.startswith("[") else []     
             
             except Exception as e:
                 logging.warning(f"[WARN] Failed to parse extracted fields. Error: {e}")
@@ -209,66 +1125,60 @@ Return a Python list of 3–4 academic subject names only. If none are identifia
         logging.info(f"[INFO] Final academic_fields: {req.academic_fields}")
         fully_discussed_fields = []
 
-        for field in req.academic_fields:
-            field_lower = field.lower()
+        with profile_phase("history_scan"):
+            for field in req.academic_fields:
+                field_lower = field.lower()
             
-            asked_about_courses = any(
-                field_lower in turn['question'].lower() and 
-                any(kw in turn['question'].lower() for kw in ["school", "course", "study"])
-                for turn in req.history
-            )
+                asked_about_courses = any(
+                    field_lower in turn['question'].lower() and 
+                    any(kw in turn['question'].lower() for kw in ["school", "course", "study"])
+                    for turn in req.history
+                )
             
-            asked_about_experiences = any(
-                field_lower in turn['question'].lower() and 
-                any(kw in turn['question'].lower() for kw in ["internship", "research", "outside", "experience"])
-                for turn in req.history
-            )
+                asked_about_experiences = any(
+                    field_lower in turn['question'].lower() and 
+                    any(kw in turn['question'].lower() for kw in ["internship", "research", "outside", "experience"])
+                    for turn in req.history
+                )
 
-            confirmed_done = any(
-                field_lower in turn['question'].lower() and 
-                "anything more" in turn['question'].lower() and
-                ("move on" in turn['answer'].lower() or "no" in turn['answer'].lower()) 
-                for turn in req.history
-            )
+                confirmed_done = any(
+                    field_lower in turn['question'].lower() and 
+                    "anything more" in turn['question'].lower() and
+                    ("move on" in turn['answer'].lower() or "no" in turn['answer'].lower()) 
+                    for turn in req.history
+                )
             
             
-            logging.info(f"[CHECK] Field: {field} | asked_about_courses: {asked_about_courses} | asked_about_experiences: {asked_about_experiences} | confirmed_done: {confirmed_done}")
+                logging.info(f"[CHECK] Field: {field} | asked_about_courses: {asked_about_courses} | asked_about_experiences: {asked_about_experiences} | confirmed_done: {confirmed_done}")
             
-            if asked_about_courses and asked_about_experiences and confirmed_done:
-                fully_discussed_fields.append(field)
+                if asked_about_courses and asked_about_experiences and confirmed_done:
+                    fully_discussed_fields.append(field)
                 
         remaining_fields = [f for f in req.academic_fields if f not in fully_discussed_fields]
 
         logging.info(f"[INFO] Fully discussed fields: {fully_discussed_fields}")
         logging.info(f"[INFO] Remaining fields: {remaining_fields}")
         
-        already_asked_fav_subjects = any(
-            "three or four of your favourite subjects" in turn["question"].lower()
-            for turn in req.history
-        )
+        with profile_phase("history_scan"):
+            already_asked_fav_subjects = any(
+                "three or four of your favourite subjects" in turn["question"].lower()
+                for turn in req.history
+            )
         
         logging.info(f"[INFO] Already asked favourite subjects? {already_asked_fav_subjects}")
         
         
         if not req.academic_fields and not already_asked_fav_subjects:
             logging.info("[ACTION] Asking for favourite subjects")
-            prompt = f"""
-The student has not yet listed their favorite academic subjects.
-
-CV of the student:
-{req.cv_text}
-
-If the CV is provided ask: "Looks like [3–4 most relevant subjects from the CV] are your favorite subjects. Regardless, could you tell me about three or four of your favourite subjects?"
-If the CV is not provided ask: "Could you tell me about three or four of your favourite subjects?"
-"""
-            response = client.chat.completions.create(
+            response = await chat_completion(
+                deadline, "ask_fav_subjects",
                 model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are a warm, perceptive assistant."},
-                    {"role": "user", "content": prompt}
-                ]
+                messages=PROMPTS["ask_fav_subjects"].messages(cv_text=req.cv_text)
             )
-            question = response.choices[0].message.content.strip()
+            if response is None:
+                question = "Could you tell me about three or four of your favourite subjects?"
+            else:
+                question = response.choices[0].message.content.strip()
             return {
                 "question": question,
                 "current_theme": "",
@@ -285,39 +1195,15 @@ If the CV is not provided ask: "Could you tell me about three or four of your fa
 
             if req.cv_text.strip().lower() != "no cv provided":
                 logging.info("[INFO] Extracting CV-based course and experience info")
-            # Use GPT to extract courses
-                gpt_course_prompt = f"""
-From the following CV, extract up to 3 specific courses or classes related to the subject "{current_field}". 
-If there are none, respond with "None".
-
-CV:
-{req.cv_text}
-"""
-                course_response = client.chat.completions.create(
-                    model="gpt-4",
-                    messages=[
-                        {"role": "system", "content": "You are an assistant extracting structured academic data from resumes."},
-                        {"role": "user", "content": gpt_course_prompt}
-                    ]
+            # Use GPT to extract courses and experiences (cached per field)
+                courses, experiences = await asyncio.gather(
+                    cv_detail(req, "extract_courses", current_field, deadline),
+                    cv_detail(req, "extract_experiences", current_field, deadline)
                 )
-                courses = course_response.choices[0].message.content.strip()
 
-            # Use GPT to extract experiences
-                gpt_experience_prompt = f"""
-From the following CV, extract up to 3 specific research projects, internships, or extracurricular experiences related to the subject "{current_field}". 
-If there are none, respond with "None".
-
-CV:
-{req.cv_text}
-"""
-                experience_response = client.chat.completions.create(
-                    model="gpt-4",
-                    messages=[
-                        {"role": "system", "content": "You are an assistant extracting structured academic data from resumes."},
-                        {"role": "user", "content": gpt_experience_prompt}
-                    ]
-                )
-                experiences = experience_response.choices[0].message.content.strip()
+                # Prepare the next field while the student answers
+                if len(remaining_fields) > 1:
+                    prefetch_cv_details(req, remaining_fields[1])
 
             subject_questions_asked = [turn['question'] for turn in req.history if current_field.lower() in turn['question'].lower()]
             last_answer = req.history[-1]['answer'].lower() if req.history else ""
@@ -337,6 +1223,7 @@ CV:
             elif not any("anything more" in q.lower() or "else you'd like to add" in q.lower() for q in subject_questions_asked):
                 question = f"Is there anything more you want to add regarding {current_field}? If so, tell it now — if not, we’ll move on."
 
+            prefetch_speech(req.session_id, question)
             return {
                 "question": question,
                 "current_theme": "",
@@ -360,50 +1247,40 @@ CV:
         last_tag = req.history[-1].get("tag", "") if req.history else ""
         logging.info(f"[INFO] Last tag in history: {last_tag}")
         
-        already_asked_top_activities = any(
-            "extracurriculars you want to talk about today" in turn["question"].lower()
-            or "could you start by listing your most important extracurricular activities" in turn["question"].lower()
-            for turn in req.history
-        )
+        with profile_phase("history_scan"):
+            already_asked_top_activities = any(
+                "extracurriculars you want to talk about today" in turn["question"].lower()
+                or "could you start by listing your most important extracurricular activities" in turn["question"].lower()
+                for turn in req.history
+            )
         
         if not req.extracurricular_fields and not already_asked_top_activities:
             logging.info("[ACTION] Asking for top extracurricular activities")
+            question = (
+                "What extracurricular activities or clubs are you involved in? This could be sport, volunteer work, "
+                "community engagement, arts/culture, or simply what you like doing in your free time. "
+                "Could you start by listing your most important extracurricular activities?"
+            )
             
             if req.cv_text and req.cv_text.strip():
                 logging.info("[INFO] CV provided, extracting top 5 impressive extracurriculars")
                 
-                extraction_prompt = f"""
-                From the following student CV, extract the 5 **most impressive and diverse** extracurricular activities that would stand out to a college admissions officer. Avoid overlapping roles (e.g., two similar research projects).
-                
-                CV:
-                {req.cv_text}
-                
-                Return them as a Python list of short activity names only.
-                """
-                
-                extraction_response = client.chat.completions.create(
+                extraction_response = await chat_completion(
+                    deadline, "extract_top_activities",
                     model="gpt-4",
-                    messages=[
-                        {"role": "system", "content": "You extract top-tier extracurricular activities for college admissions."},
-                        {"role": "user", "content": extraction_prompt}
-                    ]
+                    messages=PROMPTS["extract_top_activities"].messages(cv_text=req.cv_text)
                 )
                 
-                extracted = extraction_response.choices[0].message.content.strip()
-                logging.info(f"[INFO] Extracted top activities: {extracted}")
-                top_five = eval(extracted) if extracted.startswith("[") else []
-                formatted = ", ".join(top_five)
-                
-                question = (
-                    f"Looks like {formatted} are your most impressive extracurriculars. "
-                    "Regardless, tell me the 5 extracurriculars you want to talk about today."
-                )
-            else:
-                question = (
-                    "What extracurricular activities or clubs are you involved in? This could be sport, volunteer work, "
-                    "community engagement, arts/culture, or simply what you like doing in your free time. "
-                    "Could you start by listing your most important extracurricular activities?"
-                )
+                if extraction_response is not None:
+                    extracted = extraction_response.choices[0].message.content.strip()
+                    logging.info(f"[INFO] Extracted top activities: {extracted}")
+                    top_five = eval(extracted) if extracted.startswith("[") else []
+                    formatted = ", ".join(top_five)
+                    
+                    question = (
+                        f"Looks like {formatted} are your most impressive extracurriculars. "
+                        "Regardless, tell me the 5 extracurriculars you want to talk about today."
+                    )
             
             return {
                 "question": question,
@@ -415,25 +1292,18 @@ CV:
         if not req.extracurricular_fields and last_tag == "ask_top_activities":
             try:
                 last_answer = req.history[-1]["answer"]
-                extraction_prompt = f"""
-                The student was asked to list the 5 extracurricular activities they want to talk about today.
-
-                Here is their answer:
-                \"{last_answer}\"
-
-                Return a Python list of exactly 5 activity names only.
-                """
-                extraction_response = client.chat.completions.create(
+                extraction_response = await chat_completion(
+                    deadline, "extract_activity_list",
                     model="gpt-4",
-                    messages=[
-                        {"role": "system", "content": "You extract structured extracurricular activity names from student replies."},
-                        {"role": "user", "content": extraction_prompt}
-                    ]
+                    messages=PROMPTS["extract_activity_list"].messages(last_answer=last_answer)
                 )
                 
-                extracted = extraction_response.choices[0].message.content.strip()
-                logging.info(f"[INFO] Extracted raw activity list string: {extracted}")
-                req.extracurricular_fields = eval(extracted) if extracted.startswith("[") else []
+                if extraction_response is None:
+                    req.extracurricular_fields = [s.strip() for s in last_answer.split(",") if s.strip()]
+                else:
+                    extracted = extraction_response.choices[0].message.content.strip()
+                    logging.info(f"[INFO] Extracted raw activity list string: {extracted}")
+                    req.extracurricular_fields = eval(extracted) if extracted.startswith("[") else []
                 
             except Exception as e:
                 logging.warning(f"[WARN] Failed to parse extracurricular fields. Error: {e}")
@@ -442,73 +1312,42 @@ CV:
         fully_done = []
         for activity in req.extracurricular_fields:
             activity_lower = activity.lower()
-            relevant_turns = [turn for turn in req.history if activity_lower in turn['question'].lower()]
-            questions_asked = [turn['question'].lower() for turn in relevant_turns]
-            answers = [turn['answer'].lower() for turn in relevant_turns]
+            with profile_phase("history_scan"):
+                relevant_turns = [turn for turn in req.history if activity_lower in turn['question'].lower()]
+                questions_asked = [turn['question'].lower() for turn in relevant_turns]
+                answers = [turn['answer'].lower() for turn in relevant_turns]
             
-            asked_1 = any("how long" in q and "role" in q for q in questions_asked)
-            asked_2 = any("enjoy" in q and "rewarding" in q for q in questions_asked)
-            asked_3 = any("challenging" in q for q in questions_asked)
-            asked_4 = any("learned about yourself" in q for q in questions_asked)
-            asked_5 = any("continuing" in q or "cut back" in q for q in questions_asked)
-            asked_6 = any("anecdotes" in q or "moments" in q or "take-aways" in q for q in questions_asked)
-            asked_more = any("anything more" in q and ("no" in a or "move on" in a) for q, a in zip(questions_asked, answers))
+                asked_1 = any("how long" in q and "role" in q for q in questions_asked)
+                asked_2 = any("enjoy" in q and "rewarding" in q for q in questions_asked)
+                asked_3 = any("challenging" in q for q in questions_asked)
+                asked_4 = any("learned about yourself" in q for q in questions_asked)
+                asked_5 = any("continuing" in q or "cut back" in q for q in questions_asked)
+                asked_6 = any("anecdotes" in q or "moments" in q or "take-aways" in q for q in questions_asked)
+                asked_more = any("anything more" in q and ("no" in a or "move on" in a) for q, a in zip(questions_asked, answers))
             
             if all([asked_1, asked_2, asked_3, asked_4, asked_5, asked_6, asked_more]):
                 fully_done.append(activity)
             else:
                 logging.info(f"[ACTION] Asking next question for: {activity}")
-                if not asked_1:
-                    return {
-                        "question": f"Could you tell me more about {activity} and how long you’ve done it? What’s your role in it? What do you bring to it personally?",
-                        "current_theme": "",
-                        "theme_counts": req.theme_counts,
-                        "tag": ""
-                    }
-                elif not asked_2:
-                    return {
-                        "question": f"What do you enjoy about {activity}? What’s been most rewarding?",
-                        "current_theme": "",
-                        "theme_counts": req.theme_counts,
-                        "tag": ""
-                    }
-                elif not asked_3:
-                    return {
-                        "question": f"What have you found challenging about this work in {activity}?",
-                        "current_theme": "",
-                        "theme_counts": req.theme_counts,
-                        "tag": ""
-                    }
-                elif not asked_4:
-                    return {
-                        "question": f"What have you learned about yourself or others from your involvement in {activity}?",
-                        "current_theme": "",
-                        "theme_counts": req.theme_counts,
-                        "tag": ""
-                    }
-                elif not asked_5:
-                    return {
-                        "question": f"Do you see yourself continuing {activity}? If you’ve stopped or had to cut back (or will do in the future), how do you feel?",
-                        "current_theme": "",
-                        "theme_counts": req.theme_counts,
-                        "tag": ""
-                    }
-                
-                elif not asked_6:
-                    return {
-                        "question": f"Do you have any anecdotes, moments or take-aways that stand out from {activity}?",
-                        "current_theme": "",
-                        "theme_counts": req.theme_counts,
-                        "tag": ""
-                    }
-                
-                elif not asked_more:
-                    return {
-                        "question": f"Is there anything more you want to add regarding {activity}? If not, let’s move on.",
-                        "current_theme": "",
-                        "theme_counts": req.theme_counts,
-                        "tag": ""
-                    }
+                step = [asked_1, asked_2, asked_3, asked_4, asked_5, asked_6, asked_more].index(False)
+                question = EXTRACURRICULAR_FOLLOW_UPS[step].format(activity=activity)
+
+                # The follow-up after this one is fixed, so prepare its audio now
+                prefetch_speech(req.session_id, question)
+                if step + 1 < len(EXTRACURRICULAR_FOLLOW_UPS):
+                    prefetch_speech(req.session_id, EXTRACURRICULAR_FOLLOW_UPS[step + 1].format(activity=activity))
+                else:
+                    position = req.extracurricular_fields.index(activity)
+                    if position + 1 < len(req.extracurricular_fields):
+                        next_activity = req.extracurricular_fields[position + 1]
+                        prefetch_speech(req.session_id, EXTRACURRICULAR_FOLLOW_UPS[0].format(activity=next_activity))
+
+                return {
+                    "question": question,
+                    "current_theme": "",
+                    "theme_counts": req.theme_counts,
+                    "tag": ""
+                }
                 
         logging.info("[DONE] All activities covered.")
         return {
@@ -538,41 +1377,22 @@ CV:
         next_question = all_bg_questions[req.background_index]
         last_answer = req.history[-1]["answer"] if req.history else ""
 
-        gpt_prompt = f"""
-    You are a warm, perceptive college counselor conducting an interview with a student. 
-
-    Your goal is to ask the preset questions **one by one in the given order** from the “Family & Background” list. Do not invent new questions or reorder them. Add a short, friendly sentence that naturally reacts to the student’s **last answer**, and then ask the **next** question.
-
-    Here is the student's previous answer:
-    "{last_answer}"
-
-    The next question to ask is:
-    "{next_question}"
-
-    Begin with a natural transition or reflection, and then ask the question in a conversational tone.
-    """
-
-        response = client.chat.completions.create(
+        response = await chat_completion(
+            deadline, "family_background",
             model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are a friendly college counselor helping a student reflect on their background."},
-                {"role": "user", "content": gpt_prompt}
-            ]
+            messages=PROMPTS["family_background"].messages(last_answer=last_answer, next_question=next_question)
         )
 
-        q_text = response.choices[0].message.content.strip()
-        tag = ""
+        # Serve the raw preset if the LLM missed its budget
+        q_text = response.choices[0].message.content.strip() if response is not None else next_question
 
-        if "three or four of your favourite subjects" in q_text.lower():
-            tag = "ask_fav_subjects"
-        elif "most important 5 activities" in q_text.lower():
-            tag = "ask_top_activities"
+        prefetch_speech(req.session_id, q_text)
 
         return {
             "question": q_text,
             "current_theme": "",
             "theme_counts": req.theme_counts,
-            "tag": tag
+            "tag": question_tag(q_text)
         }
 
     elif req.track == "Academic Interests":
@@ -590,117 +1410,56 @@ CV:
         next_question = all_academic_questions[req.academic_index]
         last_answer = req.history[-1]["answer"] if req.history else ""
 
-        gpt_prompt = f"""
-    You are a warm, perceptive college counselor conducting an interview with a student. 
-
-    Your goal is to ask the preset questions **one by one in the given order** from the “Academic Interests” list. Do not invent new questions or reorder them. Add a short, friendly sentence that naturally reacts to the student’s **last answer**, and then ask the **next** question.
-
-    Here is the student's previous answer:
-    "{last_answer}"
-
-    The next question to ask is:
-    "{next_question}"
-
-    Begin with a natural transition or reflection, and then ask the question in a conversational tone.
-    """
-
-        response = client.chat.completions.create(
+        response = await chat_completion(
+            deadline, "academic_interests",
             model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are a friendly college counselor helping a student reflect on their academic life."},
-                {"role": "user", "content": gpt_prompt}
-            ]
+            messages=PROMPTS["academic_interests"].messages(last_answer=last_answer, next_question=next_question)
         )
 
-        q_text = response.choices[0].message.content.strip()
-        tag = ""
+        # Serve the raw preset if the LLM missed its budget
+        q_text = response.choices[0].message.content.strip() if response is not None else next_question
 
-        if "three or four of your favourite subjects" in q_text.lower():
-            tag = "ask_fav_subjects"
-        elif "most important 5 activities" in q_text.lower():
-            tag = "ask_top_activities"
+        prefetch_speech(req.session_id, q_text)
 
         return {
             "question": q_text,
             "current_theme": "",
             "theme_counts": req.theme_counts,
             "academic_index": req.academic_index + 1,
-            "tag": tag
+            "tag": question_tag(q_text)
         }
 
     else:
         logging.warning("[WARNING] >>> FALLING INTO DEFAULT ELSE BLOCK — using random selection")
 
-        prompt = f"""
-Your task is to:
-a. Gather as much detail as possible about the student’s academic interests or extracurricular involvement or personal background (depending on the choosen track). These details are necessary for the counselor.
-b. Build on these details with further questions about the student’s motivation and character as it relates to the subject being discussed.
-
-Student's CV:
-{req.cv_text}
-
-If the student has not provided a CV pay more attention to conversation history and preset questions.
-
-Interview Track: {req.track}
-
-Preset question to base your next move on:
-"{track_questions}"
-
-If the academic track is choosen ask at least once about challanges and obstacles in the academic life of the student.
-
-Pick the most relevant preset question from the list according to the conversation history and the CV.
-
-Conversation so far:
-{conversation_history}
-
-Themes discussed and their counts:
-{req.theme_counts}
-
-Pick a relevant theme from the list of preset themes. This should help you give direction to the question.
-
-List of preset themes:
-{themes}
-
-Instructions:
-- Check the conversation history and theme counts to see what themes have been discussed.
-- Ask at most TWO questions per theme. After two, switch to a new theme. To understand how many times the theme has been discussed check the theme counts and conversation history.
-- Prioritize themes that have NOT yet been discussed.
-- If this is not the first question, before generating a question check the conversation history to give 1-2 lines of reflection (something like that sounds interesting) to the students response and then ask the question.
-- NEVER repeat a topic already deeply discussed.
-- Build naturally based on student's previous answers.
-- Stay strictly related to the selected track unless a powerful personal connection emerges.
-- Phrase your questions conversationally, like a real human counselor talking warmly to a student.
-- Prefer open-ended questions that encourage reflection and storytelling.
-- Only output ONE question, no lists or options.
-- Do not begin with "Q:".
-
-Reminder:
-- Stay human, curious, and perceptive.
-- Adapt wording naturally using clues from the CV and past conversation.
-"""
-  # <- use your regular prompt here
+        messages = PROMPTS["default_question"].messages(
+            cv_text=req.cv_text,
+            track=req.track,
+            track_questions=track_questions,
+            theme_counts=req.theme_counts,
+            conversation_history=conversation_history
+        )
 
-    response = client.chat.completions.create(
+    response = await chat_completion(
+        deadline, "default_question",
         model="gpt-4",
-        messages=[
-            {"role": "system", "content": "You are a warm, perceptive assistant to a college counselor. The college counselor has asked you to interview the student, taking the preset questions as a starting point. The college counselor will use the interview transcript to brainstorm potential college application essay topics with the student."},
-            {"role": "user", "content": prompt}
-        ]
+        messages=messages
     )
-    question = response.choices[0].message.content.strip()
+    # Fall back to a preset that has not been asked yet if the LLM missed its budget
+    question = response.choices[0].message.content.strip() if response is not None else fallback_preset(track_questions, req.history)
 
     guessed_theme = ""
     theme_counts = req.theme_counts or {}
 
     # Only guess theme in regular phase
+    theme_response = None
     if not req.is_rapid_fire:
-        theme_response = client.chat.completions.create(
+        theme_response = await chat_completion(
+            deadline, "classify_theme",
             model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are a classifier that identifies essay themes from conversation."},
-                {"role": "user", "content": f"Given this conversation:\n{conversation_history}\n\nPick one most relevant theme from this list:\n{chr(10).join(PRESET_THEMES)}"}
-            ]
+            messages=PROMPTS["classify_theme"].messages(conversation_history=conversation_history)
         )
+    if theme_response is not None:
         raw_theme = theme_response.choices[0].message.content.strip()
         guessed_theme = next(
             (theme for theme in PRESET_THEMES if theme in raw_theme),
@@ -711,20 +1470,66 @@ Reminder:
         else:
             logging.warning(f"Could not match theme in response: {raw_theme}")
 
-    tag = ""
-    if "three or four of your favourite subjects" in question.lower():
-        tag = "ask_fav_subjects"
-    elif "most important 5 activities" in question.lower():
-        tag = "ask_top_activities"
-
     return {
         "question": question,
         "current_theme": guessed_theme,
         "theme_counts": theme_counts,
-        "tag": tag
+        "tag": question_tag(question)
     }
 
 
+# --- Endpoint: Metrics ---
+@app.get("/metrics")
+async def metrics():
+    fallbacks = {site: n for site, n in FALLBACK_COUNTS.items() if not site.startswith("prefetch:")}
+    return {
+        "deadline_fallbacks": fallbacks,
+        "deadline_fallbacks_total": sum(fallbacks.values()),
+        "prefetch_fallbacks": {site: n for site, n in FALLBACK_COUNTS.items() if site.startswith("prefetch:")},
+        "prompt_cache": {
+            site: {
+                "calls": COMPLETION_CALLS[site],
+                "prompt_tokens": PROMPT_TOKENS[site],
+                "cached_tokens": CACHED_PROMPT_TOKENS[site],
+                "cached_ratio": round(CACHED_PROMPT_TOKENS[site] / PROMPT_TOKENS[site], 3) if PROMPT_TOKENS[site] else 0.0,
+            }
+            for site in COMPLETION_CALLS
+        },
+        "prefetch": {
+            kind: {
+                "scheduled": PREFETCH_SCHEDULED[kind],
+                "hits": PREFETCH_HITS[kind],
+                "misses": PREFETCH_MISSES[kind],
+                "reused": PREFETCH_REUSED[kind],
+                "hit_rate": round(PREFETCH_HITS[kind] / (PREFETCH_HITS[kind] + PREFETCH_MISSES[kind]), 3)
+                if PREFETCH_HITS[kind] + PREFETCH_MISSES[kind] else 0.0,
+            }
+            for kind in set(PREFETCH_SCHEDULED) | set(PREFETCH_HITS) | set(PREFETCH_MISSES) | set(PREFETCH_REUSED)
+        },
+    }
+
+
+# --- Endpoint: Debug Profiles ---
+def check_debug_token(x_debug_token):
+    if not DEBUG_TOKEN or not x_debug_token or not hmac.compare_digest(x_debug_token, DEBUG_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden.")
+
+
+@app.get("/debug/profiles")
+async def list_profiles(x_debug_token: Optional[str] = Header(None)):
+    check_debug_token(x_debug_token)
+    return {"request_ids": list(reversed(PROFILES.keys()))}
+
+
+@app.get("/debug/profiles/{request_id}")
+async def get_profile(request_id: str, x_debug_token: Optional[str] = Header(None)):
+    check_debug_token(x_debug_token)
+    profile = PROFILES.get(request_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found.")
+    return profile.to_dict()
+
+
 # --- Endpoint: Speak ---
 @app.post("/speak")
 async def speak_text(request: dict):
@@ -732,6 +1537,10 @@ async def speak_text(request: dict):
     if not text:
         return {"error": "No text provided."}
 
+    hit, audio = await use_prefetched(prefetch_key(request.get("session_id", ""), "tts", text))
+    if hit:
+        return Response(content=audio, media_type="audio/mpeg")
+
     try:
         speech = client.audio.speech.create(
             model="tts-1",